@@ -1,33 +1,252 @@
 from __future__ import annotations
 
 import os
+import queue
 import sqlite3
 import re
+import threading
+import unicodedata
+from collections.abc import Iterator
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from io import BytesIO
 from secrets import randbelow
 from urllib.parse import quote
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash,
-    send_file, session, jsonify
+    Flask, Response, render_template, request, redirect, url_for, flash,
+    session, jsonify, g, has_request_context, has_app_context
 )
+from cachelib.file import FileSystemCache
+from flask_caching import Cache
+from flask_session import Session
+from jinja2 import FileSystemBytecodeCache
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(APP_DIR, "ompps.db")
 
+# init_db() 的建表/補欄位/索引/trigger 有改動時 +1，下次啟動才會重跑
+SCHEMA_VERSION = 1
+
 RETENTION_DAYS = 60
+CLEANUP_INTERVAL_SECONDS = 6 * 60 * 60
+CLEANUP_LOCK_PATH = DB_PATH + ".cleanup.lock"
+POOL_SIZE = int(os.environ.get("SQLITE_POOL", 8))
+
+# objectives 表單欄位：long_term_goal_{idx} / short_term_{idx}[]
+LT_PREFIX = "long_term_goal_"
+ST_PREFIX = "short_term_"
+ST_SUFFIX = "[]"
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-only-change-me")
 
+# session 存在伺服器端檔案，cookie 只帶 session id
+app.config["SESSION_TYPE"] = "cachelib"
+app.config["SESSION_CACHELIB"] = FileSystemCache(cache_dir=os.path.join(APP_DIR, "flask_session"), threshold=5000)
+app.config["SESSION_PERMANENT"] = False
+Session(app)
+
+# 模板編譯結果存檔，新 worker 第一次 render 不用重新 parse
+# （非 debug 時 Flask 本來就不會檢查模板是否修改）
+JINJA_CACHE_DIR = os.path.join(APP_DIR, ".jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=JINJA_CACHE_DIR)
+
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 300})
+
 # ---------- DB ----------
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# 建檔、存目標、刪除都用 INSERT/DELETE ... RETURNING：SQLite 3.35 以上才有，太舊就別啟動
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    raise RuntimeError(
+        f"SQLite >= 3.35 is required (RETURNING); found {sqlite3.sqlite_version}"
+    )
+
+def _open_conn() -> sqlite3.Connection:
+    # isolation_level=None：交易改由 get_conn()/transaction() 自己控制
+    # detect_types=0：不做 PARSE_DECLTYPES 之類的欄位轉換（日期都是存字串）
+    # cached_statements：下面 SQL_* 常用查詢都留在 prepared statement cache 裡
+    conn = sqlite3.connect(
+        DB_PATH, check_same_thread=False, isolation_level=None, detect_types=0, cached_statements=256
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.text_factory = str
+    # journal_mode=WAL 存在 DB 檔裡，init_db() 設一次就好；下面這些是連線層級，每條都要設
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA cache_size=-20000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA foreign_keys=ON;")
     return conn
 
+
+class ConnectionPool:
+    """長駐 SQLite 連線池：連線用到才開，最多 size 條，用完放回（LIFO 讓常用連線的 cache 保持熱的）"""
+
+    def __init__(self, size: int) -> None:
+        self._size = max(1, size)
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=self._size)
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self._size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return _open_conn()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        # 池子滿了就等別人還
+        return self._idle.get()
+
+    def put(self, conn: sqlite3.Connection) -> None:
+        self._idle.put(conn)
+
+
+_pool = ConnectionPool(POOL_SIZE)
+_tls = threading.local()
+
+
+def db() -> sqlite3.Connection:
+    """
+    這個 request 專用的連線：第一次用到才從池子借，teardown 時才還。
+    一個 request 裡不管呼叫幾個 helper 都只借一次；唯讀查詢直接用（autocommit，不開交易）。
+    """
+    conn = g.get("_db")
+    if conn is None:
+        conn = g._db = _pool.get()
+    return conn
+
+
+@app.teardown_appcontext
+def _release_db(exc: BaseException | None) -> None:
+    conn = g.pop("_db", None)
+    if conn is None:
+        return
+    # 正常情況 get_conn()/transaction() 都收尾了；保險起見別把半套交易還回池子
+    if conn.in_transaction:
+        conn.rollback()
+    _pool.put(conn)
+
+
+@contextmanager
+def get_conn():
+    """
+    借一條連線；正常離開 commit、出錯 rollback。
+    request 裡用 db() 那條（歸還交給 teardown）；背景 thread / init_db 直接跟池子借、用完還回去。
+    同一個 thread 裡巢狀呼叫會拿到同一條連線（由最外層負責 commit/歸還），
+    不會一次佔掉兩條、也不會在池子滿時自己等自己。
+    """
+    conn = getattr(_tls, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+
+    owned = not has_app_context()
+    conn = _pool.get() if owned else db()
+    _tls.conn = conn
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        _tls.conn = None
+        if owned:
+            _pool.put(conn)
+
+@contextmanager
+def transaction():
+    """
+    多筆寫入用：BEGIN IMMEDIATE 一開始就拿寫鎖，COMMIT/ROLLBACK 交給 get_conn()。
+    已經在交易裡（巢狀呼叫）就直接沿用外層交易。
+    """
+    with get_conn() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+
+# ---------- 常用查詢 ----------
+# 只撈畫面/匯出真的會用到的欄位，不用 SELECT *
+WS_COLS = "id, code, student_name, agency"
+
+# rev 給匯出快取當版本用
+SQL_WORKSPACE_BY_CODE = f"SELECT {WS_COLS}, rev FROM workspaces WHERE code=?"
+
+SQL_WORKSPACE_BY_STUDENT = f"""
+SELECT {WS_COLS} FROM workspaces
+WHERE student_name=? AND agency=?
+ORDER BY id DESC LIMIT 1
+"""
+
+SQL_INSERT_WORKSPACE = f"""
+INSERT INTO workspaces(code, created_at, updated_at, student_name, agency)
+VALUES(?, ?, ?, ?, ?)
+ON CONFLICT(code) DO NOTHING
+RETURNING {WS_COLS}
+"""
+
+# workspace + 本類別 objectives 一起 JOIN（objectives 沒資料時 o.* 全是 NULL）
+SQL_WORKSPACE_WITH_OBJECTIVES = """
+SELECT w.id, w.code, w.student_name, w.agency,
+       o.category, o.target_date, o.teaching_goal
+FROM workspaces w
+LEFT JOIN objectives o ON o.workspace_id = w.id AND o.category = ?
+WHERE w.code=?
+"""
+
+SQL_GET_RECORDS = """
+SELECT id, teach_date, teach_time, effectiveness FROM records
+WHERE workspace_id=? AND category=?
+ORDER BY created_at ASC, id ASC
+"""
+
+SQL_GET_GROUPS_WITH_TERMS = """
+SELECT g.id AS id, g.long_term_goal, s.id AS sid, s.item
+FROM long_term_groups g
+LEFT JOIN short_terms s ON s.group_id = g.id
+WHERE g.workspace_id=? AND g.category=?
+ORDER BY g.ord ASC, g.id ASC, s.ord ASC, s.id ASC
+"""
+
+# 匯出用（tuple 列，照位置取值）：一次撈要匯出的類別，帶 category 給 Python 分桶
+# 參數：(ws_id, cat1, cat2)；只匯單一類別時 cat1 == cat2
+SQL_EXPORT_OBJECTIVES = """
+SELECT category, target_date, teaching_goal FROM objectives
+WHERE workspace_id=? AND category IN (?, ?)
+"""
+
+SQL_EXPORT_GROUPS = """
+SELECT g.category, g.id, g.long_term_goal, s.item
+FROM long_term_groups g
+LEFT JOIN short_terms s ON s.group_id = g.id
+WHERE g.workspace_id=? AND g.category IN (?, ?)
+ORDER BY g.category, g.ord ASC, g.id ASC, s.ord ASC, s.id ASC
+"""
+
+SQL_EXPORT_RECORDS = """
+SELECT category, teach_date, teach_time, effectiveness FROM records
+WHERE workspace_id=? AND category IN (?, ?)
+ORDER BY category, created_at ASC, id ASC
+"""
+
 def migrate_objectives_table(conn: sqlite3.Connection) -> None:
 
     # 0️⃣ workspaces 不存在就別搬（防爆）
@@ -102,8 +321,13 @@ def migrate_objectives_table(conn: sqlite3.Connection) -> None:
 
 def init_db() -> None:
     with get_conn() as conn:
-        # SQLite foreign_keys 是連線層級
-        conn.execute("PRAGMA foreign_keys = ON;")
+        # 已經是最新 schema 就什麼都不用做（每個 worker 啟動只多一個 PRAGMA）
+        if conn.execute("PRAGMA user_version;").fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # WAL 是 DB 檔層級的設定，切一次之後所有連線都沿用
+        mode = conn.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+        print(f"[db] journal_mode={mode}")
 
         # 1) 建表（新裝/空 DB 會直接用這套）
         conn.executescript(
@@ -159,6 +383,8 @@ def init_db() -> None:
             "ALTER TABLE workspaces ADD COLUMN student_name TEXT;",
             "ALTER TABLE workspaces ADD COLUMN agency TEXT;",
             "ALTER TABLE workspaces ADD COLUMN updated_at TEXT;",
+            # rev：每次寫入 +1（由 trigger 維護），給匯出快取當版本；updated_at 只到秒，不夠用
+            "ALTER TABLE workspaces ADD COLUMN rev INTEGER NOT NULL DEFAULT 0;",
         ]:
             try:
                 conn.execute(sql)
@@ -185,6 +411,21 @@ def init_db() -> None:
         except sqlite3.OperationalError:
             pass
 
+        # 5b) updated_at 一律有值：舊資料補 created_at，新資料沒給就由 trigger 補
+        #     這樣清理過期資料可以直接 `updated_at < ?` 走索引（COALESCE 會讓索引失效）
+        conn.execute("UPDATE workspaces SET updated_at=created_at WHERE updated_at IS NULL;")
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_workspaces_updated_default
+            AFTER INSERT ON workspaces
+            WHEN NEW.updated_at IS NULL
+            BEGIN
+              UPDATE workspaces SET updated_at=NEW.created_at WHERE id=NEW.id;
+            END;
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_workspaces_updated ON workspaces(updated_at);")
+
         # 6) objectives 搬表（舊版 workspace_id 單一 PK 那種）
         #    搬表會牽涉 FK：最穩做法是搬表時暫關 FK
         conn.execute("PRAGMA foreign_keys = OFF;")
@@ -195,20 +436,76 @@ def init_db() -> None:
 
         for sql in [
             "CREATE INDEX IF NOT EXISTS ix_objectives_ws_cat ON objectives(workspace_id, category);",
-            "CREATE INDEX IF NOT EXISTS ix_groups_ws_cat ON long_term_groups(workspace_id, category, ord);",
-            "CREATE INDEX IF NOT EXISTS ix_records_ws_cat ON records(workspace_id, category, created_at);",
+            # 索引欄位順序 = 查詢的 WHERE + ORDER BY，讓 SQLite 直接照索引順序走、不用另外排序
+            "DROP INDEX IF EXISTS ix_groups_ws_cat;",
+            "DROP INDEX IF EXISTS ix_records_ws_cat;",
+            "CREATE INDEX IF NOT EXISTS ix_groups_ws_cat_ord ON long_term_groups(workspace_id, category, ord, id);",
+            "CREATE INDEX IF NOT EXISTS ix_records_ws_cat_created ON records(workspace_id, category, created_at, id);",
+            "CREATE INDEX IF NOT EXISTS ix_short_terms_group_ord ON short_terms(group_id, ord, id);",
         ]:
             try:
                 conn.execute(sql)
             except sqlite3.OperationalError:
                 pass
 
+        # 第一次建好索引後跑一次 ANALYZE，讓 query planner 有統計資料可用
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1';"
+        ).fetchone()
+        if not has_stats:
+            conn.execute("ANALYZE;")
+
+        # 寫入時由 trigger 順手更新 workspaces.updated_at / rev，handler 不用再多下一個 UPDATE
+        # （要放在 objectives 搬表之後：DROP TABLE 會連 trigger 一起刪掉）
+        conn.executescript(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_records_insert_bump
+            AFTER INSERT ON records
+            BEGIN
+              UPDATE workspaces SET updated_at=NEW.created_at, rev=rev+1 WHERE id=NEW.workspace_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_records_delete_bump
+            AFTER DELETE ON records
+            BEGIN
+              UPDATE workspaces SET updated_at=datetime('now', 'localtime'), rev=rev+1 WHERE id=OLD.workspace_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_objectives_insert_bump
+            AFTER INSERT ON objectives
+            BEGIN
+              UPDATE workspaces SET updated_at=datetime('now', 'localtime'), rev=rev+1 WHERE id=NEW.workspace_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_objectives_update_bump
+            AFTER UPDATE ON objectives
+            BEGIN
+              UPDATE workspaces SET updated_at=datetime('now', 'localtime'), rev=rev+1 WHERE id=NEW.workspace_id;
+            END;
+            """
+        )
+
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+
 def now_iso() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # 'YYYY-MM-DD HH:MM:SS'（isoformat 不用解析格式字串）
+    # 同一個 request 內只算一次：這次寫入的所有時間戳都一致
+    if not has_request_context():
+        return datetime.now().isoformat(sep=" ", timespec="seconds")
+    ts = getattr(g, "_now", None)
+    if ts is None:
+        ts = g._now = datetime.now().isoformat(sep=" ", timespec="seconds")
+    return ts
 
 
 def today_ymd() -> str:
-    return datetime.now().strftime("%Y-%m-%d")
+    # 同一個 request 內只算一次；跟 now_iso() 同一刻，避免跨午夜時日期對不上
+    if not has_request_context():
+        return datetime.now().strftime("%Y-%m-%d")
+    d = getattr(g, "_today", None)
+    if d is None:
+        d = g._today = now_iso()[:10]
+    return d
 
 def pick_latest_ymd(*dates: str) -> str:
     """
@@ -239,11 +536,7 @@ def find_workspace_by_student(student_name: str, agency: str) -> sqlite3.Row | N
     ag = (agency or "").strip()
     if not sn or not ag:
         return None
-    with get_conn() as conn:
-        return conn.execute(
-            "SELECT * FROM workspaces WHERE student_name=? AND agency=? ORDER BY id DESC LIMIT 1",
-            (sn, ag)
-        ).fetchone()
+    return db().execute(SQL_WORKSPACE_BY_STUDENT, (sn, ag)).fetchone()
 
 
 def create_workspace(student_name: str, agency: str) -> sqlite3.Row:
@@ -252,116 +545,152 @@ def create_workspace(student_name: str, agency: str) -> sqlite3.Row:
     if not sn or not ag:
         raise ValueError("student_name/agency required")
 
+    ts = now_iso()
     with get_conn() as conn:
-        code = make_code()
-        while conn.execute("SELECT 1 FROM workspaces WHERE code=?", (code,)).fetchone():
-            code = make_code()
-
-        conn.execute(
-            "INSERT INTO workspaces(code, created_at, updated_at, student_name, agency) VALUES(?, ?, ?, ?, ?)",
-            (code, now_iso(), now_iso(), sn, ag)
-        )
-        ws = conn.execute("SELECT * FROM workspaces WHERE code=?", (code,)).fetchone()
-        return ws
+        # code 有 UNIQUE：直接 INSERT，撞號才重抽（不先 SELECT 檢查）
+        # RETURNING（SQLite 3.35+）讓 INSERT 直接回傳整列，不用再 SELECT 一次
+        # 只對 code 做 DO NOTHING：撞號回傳 None 就重抽；
+        # 學員+單位重複（ux_student_agency）照樣丟 IntegrityError 給呼叫端處理
+        for _ in range(8):
+            ws = conn.execute(SQL_INSERT_WORKSPACE, (make_code(), ts, ts, sn, ag)).fetchone()
+            if ws is not None:
+                return ws
+        raise RuntimeError("could not allocate a unique workspace code")
 
 def get_workspace_by_code(code: str) -> sqlite3.Row | None:
-    with get_conn() as conn:
-        return conn.execute("SELECT * FROM workspaces WHERE code=?", (code,)).fetchone()
+    # 同一個 request 內同一個代碼只查一次（刪除 workspace 時要記得清掉）
+    memo = g.setdefault("_ws_by_code", {})
+    if code not in memo:
+        memo[code] = db().execute(SQL_WORKSPACE_BY_CODE, (code,)).fetchone()
+    return memo[code]
 
 def norm_cat(category: str) -> str:
     c = (category or "").strip()
     return c if c in ("定向", "生活") else "定向"
 
-def get_objectives(ws_id: int, category: str) -> sqlite3.Row | None:
-    cat = norm_cat(category)
-    with get_conn() as conn:
-        return conn.execute(
-            "SELECT * FROM objectives WHERE workspace_id=? AND category=?",
-            (ws_id, cat)
-        ).fetchone()
+def _fetch_records(conn: sqlite3.Connection, ws_id: int, cat: str) -> list[sqlite3.Row]:
+    return conn.execute(SQL_GET_RECORDS, (ws_id, cat)).fetchall()
 
+def _fetch_groups(conn: sqlite3.Connection, ws_id: int, cat: str) -> tuple[list[sqlite3.Row], dict[int, list[sqlite3.Row]]]:
+    """長期目標 + 短期目標用一個 LEFT JOIN 撈完，掃一遍分成 groups 與 st_map"""
+    rows = conn.execute(SQL_GET_GROUPS_WITH_TERMS, (ws_id, cat)).fetchall()
+
+    groups: list[sqlite3.Row] = []
+    st_map: dict[int, list[sqlite3.Row]] = {}
+    for r in rows:
+        gid = r["id"]
+        if not groups or groups[-1]["id"] != gid:
+            groups.append(r)
+        if r["sid"] is not None:
+            st_map.setdefault(gid, []).append(r)
+    return groups, st_map
 
 def get_records(ws_id: int, category: str) -> list[sqlite3.Row]:
-    cat = norm_cat(category)
-    with get_conn() as conn:
-        return conn.execute(
-            """
-            SELECT * FROM records
-            WHERE workspace_id=? AND category=?
-            ORDER BY created_at ASC, id ASC
-            """,
-            (ws_id, cat)
-        ).fetchall()
+    return _fetch_records(db(), ws_id, norm_cat(category))
 
 
-def get_long_term_groups(ws_id: int, category: str) -> list[sqlite3.Row]:
+def load_objectives_view(code: str, category: str):
+    """
+    objectives 頁 GET 用：一條連線、兩個查詢。
+    回傳 (ws, obj, groups, st_map)；找不到代碼回 None。
+    """
     cat = norm_cat(category)
-    with get_conn() as conn:
-        return conn.execute(
-            """
-            SELECT * FROM long_term_groups
-            WHERE workspace_id=? AND category=?
-            ORDER BY ord ASC, id ASC
-            """,
-            (ws_id, cat)
-        ).fetchall()
-
-def get_short_terms_by_group_ids(group_ids: list[int]) -> dict[int, list[sqlite3.Row]]:
-    if not group_ids:
-        return {}
-    placeholders = ",".join(["?"] * len(group_ids))
-    with get_conn() as conn:
-        rows = conn.execute(
-            f"""
-            SELECT * FROM short_terms
-            WHERE group_id IN ({placeholders})
-            ORDER BY group_id ASC, ord ASC, id ASC
-            """,
-            tuple(group_ids)
-        ).fetchall()
-    out: dict[int, list[sqlite3.Row]] = {}
-    for r in rows:
-        out.setdefault(r["group_id"], []).append(r)
-    return out
+    conn = db()
+    ws = conn.execute(SQL_WORKSPACE_WITH_OBJECTIVES, (cat, code)).fetchone()
+    if not ws:
+        return None
+    obj = ws if ws["category"] is not None else None
+    groups, st_map = _fetch_groups(conn, ws["id"], cat)
+    return ws, obj, groups, st_map
+
+def load_records_view(code: str, category: str):
+    """records 頁 GET 用：workspace + 本類別記錄用同一條連線撈；找不到代碼回 None"""
+    conn = db()
+    ws = conn.execute(SQL_WORKSPACE_BY_CODE, (code,)).fetchone()
+    if not ws:
+        return None
+    return ws, _fetch_records(conn, ws["id"], norm_cat(category))
 
 def init_workspace_defaults(ws_id: int) -> None:
     """新建 workspace 後的預設資料：定向/生活 各一筆 objectives + 各一組預設長期目標"""
-    with get_conn() as conn:
-        # objectives：兩類別各一筆
-        for cat in ("定向", "生活"):
-            conn.execute(
-                """
-                INSERT OR IGNORE INTO objectives(workspace_id, category, target_date, teaching_goal)
-                VALUES(?, ?, ?, ?)
-                """,
-                (ws_id, cat, today_ymd(), "")
-            )
-
-            # long_term_groups：兩類別各至少一組
-            conn.execute(
-                """
-                INSERT INTO long_term_groups(workspace_id, category, long_term_goal, ord)
-                VALUES(?, ?, ?, ?)
-                """,
-                (ws_id, cat, "感官知覺/動作能力", 1)
-            )
+    cats = ("定向", "生活")
+    with transaction() as conn:
+        # objectives：兩類別各一筆（已存在就保留原本內容）
+        conn.executemany(
+            """
+            INSERT INTO objectives(workspace_id, category, target_date, teaching_goal)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(workspace_id, category) DO NOTHING
+            """,
+            [(ws_id, cat, today_ymd(), "") for cat in cats]
+        )
 
-def cleanup_expired_workspaces() -> int:
-    cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
-    with get_conn() as conn:
-        cur = conn.execute(
+        # long_term_groups：兩類別各至少一組
+        conn.executemany(
             """
-            DELETE FROM workspaces
-            WHERE COALESCE(updated_at, created_at) < ?
+            INSERT INTO long_term_groups(workspace_id, category, long_term_goal, ord)
+            VALUES(?, ?, ?, ?)
             """,
-            (cutoff,)
+            [(ws_id, cat, "感官知覺/動作能力", 1) for cat in cats]
         )
+
+def cleanup_expired_workspaces() -> int:
+    cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).isoformat(sep=" ", timespec="seconds")
+    with get_conn() as conn:
+        cur = conn.execute("DELETE FROM workspaces WHERE updated_at < ?", (cutoff,))
     return cur.rowcount
 
+# 搶到清理鎖的 worker 一直握著（process 結束才放），其他 worker 每輪醒來都直接略過
+_cleanup_lock_file = None
+
+def _holds_cleanup_lock() -> bool:
+    global _cleanup_lock_file
+    if fcntl is None:  # Windows 沒 fcntl：開發用單一 process，直接清
+        return True
+    if _cleanup_lock_file is not None:
+        return True
+    f = open(CLEANUP_LOCK_PATH, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _cleanup_lock_file = f
+    return True
+
+def _cleanup_once() -> None:
+    # 多個 gunicorn worker 只有握著檔案鎖的那個會清；它掛了鎖就放掉，下一輪換別人接手
+    if not _holds_cleanup_lock():
+        return
+    n = cleanup_expired_workspaces()
+    if n:
+        print(f"[cleanup] removed {n} workspaces")
+
+def _cleanup_loop() -> None:
+    try:
+        _cleanup_once()
+    except Exception as e:
+        print("[cleanup] failed:", e)
+    _schedule_cleanup(CLEANUP_INTERVAL_SECONDS)
+
+def _schedule_cleanup(delay: float) -> None:
+    t = threading.Timer(delay, _cleanup_loop)
+    t.daemon = True
+    t.start()
+
 init_db()
 
 # ---------- Routes ----------
+def _s(key: str, default: str = "") -> str:
+    # 表單欄位：沒填或空字串就用 default，最後一律 strip
+    return (request.form.get(key) or default).strip()
+
+def _home_is_personal() -> bool:
+    # 有 flash 或還沒按「我已記下」的代碼 modal 時，頁面因人而異，不能共用快取
+    return bool(session.get("_flashes")) or bool(session.get("last_code") and not session.get("code_ack"))
+
 @app.route("/")
+@cache.cached(timeout=3600, unless=_home_is_personal)
 def home():
     return render_template("home.html")
 
@@ -383,8 +712,10 @@ def student():
 
     if not ws:
         try:
-            ws = create_workspace(student_name, agency)
-            init_workspace_defaults(ws["id"])
+            # 建檔 + 預設資料同一個交易：不會留下沒有預設目標的 workspace
+            with transaction():
+                ws = create_workspace(student_name, agency)
+                init_workspace_defaults(ws["id"])
         except sqlite3.IntegrityError:
             ws = find_workspace_by_student(student_name, agency)
 
@@ -410,7 +741,7 @@ def continue_module(module: str):
         return redirect(url_for("home"))
 
     if request.method == "POST":
-        code = (request.form.get("code") or "").strip()
+        code = _s("code")
         ws = get_workspace_by_code(code)
         if not ws:
             flash("找不到這個代碼，請確認後再試一次。")
@@ -428,45 +759,51 @@ def objectives(code: str):
     if cat not in ("定向", "生活"):
         cat = "定向"
 
-    ws = get_workspace_by_code(code)
+    if request.method == "GET":
+        view = load_objectives_view(code, cat)
+        ws = view[0] if view else None
+    else:
+        ws = get_workspace_by_code(code)
     if not ws:
         flash("找不到這個代碼。")
         return redirect(url_for("home"))
 
     ws_id = ws["id"]
-    obj = get_objectives(ws_id, cat)
 
     if request.method == "POST":
-        target_date = (request.form.get("target_date") or today_ymd()).strip()
-        teaching_goal = (request.form.get("teaching_goal") or "").strip()
+        target_date = _s("target_date", today_ymd())
+        teaching_goal = _s("teaching_goal")
 
         # 解析多個長期目標群組：long_term_goal_0, long_term_goal_1, ...
-        group_idxs: list[int] = []
-        for k in request.form.keys():
-            m = re.match(r"^long_term_goal_(\d+)$", k)
-            if m:
-                group_idxs.append(int(m.group(1)))
-        group_idxs = sorted(set(group_idxs))
-
-        if not group_idxs:
+        # 掃一遍 form.lists() 就同時拿到長期目標與各組 short_term_{idx}[]
+        lts: dict[int, str] = {}
+        shorts: dict[int, list[str]] = {}
+        for k, vals in request.form.lists():
+            if k.startswith(ST_PREFIX) and k.endswith(ST_SUFFIX):
+                n = k[len(ST_PREFIX):-len(ST_SUFFIX)]
+                if n.isdecimal():
+                    shorts[int(n)] = [t for v in vals if (t := v.strip())]
+            elif k.startswith(LT_PREFIX):
+                n = k[len(LT_PREFIX):]
+                if n.isdecimal():
+                    lts[int(n)] = vals[0].strip()
+
+        if not lts:
             flash("至少需要一個長期目標。")
             return redirect(url_for("objectives", code=code, cat=cat))
 
-        groups_payload: list[tuple[str, list[str]]] = []
-        for idx in group_idxs:
-            lt = (request.form.get(f"long_term_goal_{idx}") or "").strip()
-            if not lt:
-                continue
-            sts = request.form.getlist(f"short_term_{idx}[]")
-            sts = [s.strip() for s in sts if s.strip()]
-            groups_payload.append((lt, sts))
+        groups_payload: list[tuple[str, list[str]]] = [
+            (lts[idx], shorts.get(idx, []))
+            for idx in sorted(lts)
+            if lts[idx]
+        ]
 
         if not groups_payload:
             flash("長期目標不可全空白。")
             return redirect(url_for("objectives", code=code, cat=cat))
 
-        with get_conn() as conn:
-            ts = now_iso()
+        # 整批 UPSERT + DELETE + INSERT 在同一個交易裡，一次 COMMIT
+        with transaction() as conn:
 
             # objectives：同一個 ws 允許 定向/生活 各一筆
             conn.execute(
@@ -486,34 +823,36 @@ def objectives(code: str):
                 (ws_id, cat)
             )
 
-            # ✅ 重建群組 + short_terms
-            for ord_idx, (lt, sts) in enumerate(groups_payload, start=1):
-                cur = conn.execute(
-                    """
-                    INSERT INTO long_term_groups(workspace_id, category, long_term_goal, ord)
-                    VALUES(?, ?, ?, ?)
-                    """,
-                    (ws_id, cat, lt, ord_idx)
-                )
-                group_id = cur.lastrowid
-
-                for st_ord, item in enumerate(sts, start=1):
-                    conn.execute(
-                        "INSERT INTO short_terms(group_id, item, ord) VALUES(?, ?, ?)",
-                        (group_id, item, st_ord)
-                    )
-
-            conn.execute(
-                "UPDATE workspaces SET updated_at=? WHERE id=?",
-                (ts, ws_id)
+            # ✅ 重建群組 + short_terms（整批寫入，不逐筆 INSERT）
+            # 群組用一個多列 INSERT ... RETURNING 拿回 (id, ord)，不用再 SELECT 回來對
+            # （executemany 會丟掉 RETURNING 的結果）
+            lt_sql = (
+                "INSERT INTO long_term_groups(workspace_id, category, long_term_goal, ord) VALUES "
+                + ", ".join(["(?, ?, ?, ?)"] * len(groups_payload))
+                + " RETURNING id, ord"
+            )
+            lt_params = [
+                v
+                for ord_idx, (lt, _) in enumerate(groups_payload, start=1)
+                for v in (ws_id, cat, lt, ord_idx)
+            ]
+            # RETURNING 的列順序不保證，用 ord 對回去
+            gid_by_ord = {r["ord"]: r["id"] for r in conn.execute(lt_sql, lt_params).fetchall()}
+            st_rows = [
+                (gid_by_ord[ord_idx], item, st_ord)
+                for ord_idx, (_, sts) in enumerate(groups_payload, start=1)
+                for st_ord, item in enumerate(sts, start=1)
+            ]
+            conn.executemany(
+                "INSERT INTO short_terms(group_id, item, ord) VALUES(?, ?, ?)",
+                st_rows
             )
 
         flash(f"已儲存：教學目標（{cat}）")
         return redirect(url_for("objectives", code=code, cat=cat))
 
     # GET
-    groups = get_long_term_groups(ws_id, cat)
-    st_map = get_short_terms_by_group_ids([g["id"] for g in groups])
+    _, obj, groups, st_map = view
 
     return render_template(
         "objectives.html",
@@ -527,56 +866,63 @@ def objectives(code: str):
 
 @app.route("/records/<code>", methods=["GET", "POST"])
 def records(code: str):
-    ws = get_workspace_by_code(code)
-    if not ws:
-        flash("找不到這個代碼。")
-        return redirect(url_for("home"))
-
     cat = (request.args.get("cat") or request.form.get("cat") or "定向").strip()
     if cat not in ("定向", "生活"):
         cat = "定向"
 
+    if request.method == "GET":
+        view = load_records_view(code, cat)
+        ws = view[0] if view else None
+    else:
+        view = None
+        ws = get_workspace_by_code(code)
+    if not ws:
+        flash("找不到這個代碼。")
+        return redirect(url_for("home"))
+
     ws_id = ws["id"]
 
     if request.method == "POST":
-        action = (request.form.get("action") or "").strip()
+        action = _s("action")
 
         if action == "add":
-            teach_date = (request.form.get("teach_date") or today_ymd()).strip()
-            teach_time = (request.form.get("teach_time") or "").strip()
-            effectiveness = (request.form.get("effectiveness") or "").strip()
+            teach_date = _s("teach_date", today_ymd())
+            teach_time = _s("teach_time")
+            effectiveness = _s("effectiveness")
 
             if not teach_time:
                 flash("教學時間不可空白（例如：14:00-16:00）。")
                 return redirect(url_for("records", code=code, cat=cat))
 
-            ts = now_iso()
+            # updated_at 由 trg_records_insert_bump 一起更新
             with get_conn() as conn:
                 conn.execute(
                     """
                     INSERT INTO records(workspace_id, category, teach_date, teach_time, effectiveness, created_at)
                     VALUES(?, ?, ?, ?, ?, ?)
                     """,
-                    (ws_id, cat, teach_date, teach_time, effectiveness, ts)
+                    (ws_id, cat, teach_date, teach_time, effectiveness, now_iso())
                 )
-                conn.execute("UPDATE workspaces SET updated_at=? WHERE id=?", (ts, ws_id))
 
             flash("已新增一筆教學記錄。")
             return redirect(url_for("records", code=code, cat=cat))
 
         if action == "delete":
-            rec_id = (request.form.get("rec_id") or "").strip()
+            rec_id = _s("rec_id")
             if rec_id.isdigit():
+                # 跟刪 workspace 一樣：RETURNING 有東西才代表真的刪到
                 with get_conn() as conn:
-                    conn.execute(
-                        "DELETE FROM records WHERE id=? AND workspace_id=? AND category=?",
+                    deleted = conn.execute(
+                        "DELETE FROM records WHERE id=? AND workspace_id=? AND category=? RETURNING id",
                         (int(rec_id), ws_id, cat)
-                    )
-                flash("已刪除該筆記錄。")
+                    ).fetchone()
+                if deleted:
+                    flash("已刪除該筆記錄。")
 
             return redirect(url_for("records", code=code, cat=cat))
 
-    recs = get_records(ws_id, cat)
+    # GET（POST 沒對上任何 action 時也會落到這裡）
+    recs = view[1] if view else get_records(ws_id, cat)
     return render_template(
         "records.html",
         code=code,
@@ -586,61 +932,95 @@ def records(code: str):
         cat=cat
     )
 
-def build_export_text(ws_id: int, category: str) -> str:
-    lines: list[str] = []
-
-    def one(cat: str):
-        obj = get_objectives(ws_id, cat)
-        groups = get_long_term_groups(ws_id, cat)
-        st_map = get_short_terms_by_group_ids([g["id"] for g in groups])
-        recs = get_records(ws_id, cat)
-
-        lines.append(f"【教學目標｜{cat}】")
-        if obj:
-            lines.append(f"訂定日期：{obj['target_date']}")
-            lines.append("教學目標：")
-            lines.append(obj["teaching_goal"] or "（未填）")
-        else:
-            lines.append("（尚未填寫）")
-        lines.append("")
-
-        lines.append("長期目標與短期目標：")
-        if groups:
-            for i, g in enumerate(groups, start=1):
-                lines.append(f"長期目標{i}. {g['long_term_goal']}")
-                sts = st_map.get(g["id"], [])
-                if sts:
-                    for j, st in enumerate(sts, start=1):
-                        lines.append(f"  {j}. {st['item']}")
-                else:
-                    lines.append("  （未填短期目標）")
-                lines.append("")
-        else:
-            lines.append("（未填長期/短期目標）")
-            lines.append("")
-
-        lines.append(f"【教學記錄｜{cat}】")
-        if not recs:
-            lines.append("（尚未新增）")
-        else:
-            for idx, r in enumerate(recs, start=1):
-                lines.append(f"第{idx}次")
-                lines.append(f"教學日期：{r['teach_date']}")
-                lines.append(f"教學時間：{r['teach_time']}")
-                lines.append("教學成效評估：")
-                lines.append(r["effectiveness"] or "")
-                lines.append("")
-        lines.append("")
-
-    if category == "both":
-        one("定向")
-        lines.append("========")  # ✅ 只在中間分隔一次
-        lines.append("")
-        one("生活")
+def load_export_data(ws_id: int, cats: tuple[str, ...]) -> dict[str, dict]:
+    """
+    匯出用：一條連線、三個查詢把要匯出的類別全部撈完，再照 category 分桶。
+    回傳 {cat: {"obj": (target_date, teaching_goal) | None,
+                "groups": [(長期目標, [短期目標...]), ...],
+                "recs": [(teach_date, teach_time, effectiveness), ...]}}
+    """
+    params = (ws_id, cats[0], cats[-1])
+    # 只照位置取值：用 tuple 列（row_factory=None）比 sqlite3.Row 的欄名查找省
+    cur = db().cursor()
+    cur.row_factory = None
+    obj_rows = cur.execute(SQL_EXPORT_OBJECTIVES, params).fetchall()
+    group_rows = cur.execute(SQL_EXPORT_GROUPS, params).fetchall()
+    rec_rows = cur.execute(SQL_EXPORT_RECORDS, params).fetchall()
+
+    data: dict[str, dict] = {c: {"obj": None, "groups": [], "recs": []} for c in cats}
+    for c, target_date, teaching_goal in obj_rows:
+        data[c]["obj"] = (target_date, teaching_goal)
+
+    # 照 JOIN 的順序掃一遍分組
+    last_gid = None
+    for c, gid, lt, item in group_rows:
+        groups = data[c]["groups"]
+        if gid != last_gid:
+            groups.append((lt, []))
+            last_gid = gid
+        if item is not None:
+            groups[-1][1].append(item)
+
+    for c, *rec in rec_rows:
+        data[c]["recs"].append(rec)
+    return data
+
+def _export_section(cat: str, obj: tuple[str, str] | None,
+                    groups: list[tuple[str, list[str]]], recs: list) -> str:
+    """單一類別的匯出內容：各段先組好，再套進一個 f-string 樣板"""
+    if obj:
+        target_date, teaching_goal = obj
+        obj_block = f"訂定日期：{target_date}\n教學目標：\n{teaching_goal or '（未填）'}"
+    else:
+        obj_block = "（尚未填寫）"
+
+    if groups:
+        group_blocks = "\n".join(
+            f"長期目標{i}. {lt}\n"
+            + ("\n".join(f"  {j}. {item}" for j, item in enumerate(items, start=1))
+               or "  （未填短期目標）")
+            + "\n"
+            for i, (lt, items) in enumerate(groups, start=1)
+        )
     else:
-        one(category)
+        group_blocks = "（未填長期/短期目標）\n"
+
+    if recs:
+        rec_blocks = "\n".join(
+            f"第{idx}次\n"
+            f"教學日期：{teach_date}\n"
+            f"教學時間：{teach_time}\n"
+            f"教學成效評估：\n"
+            f"{effectiveness or ''}\n"
+            for idx, (teach_date, teach_time, effectiveness) in enumerate(recs, start=1)
+        )
+    else:
+        rec_blocks = "（尚未新增）"
+
+    return (
+        f"【教學目標｜{cat}】\n{obj_block}\n\n"
+        f"長期目標與短期目標：\n{group_blocks}\n"
+        f"【教學記錄｜{cat}】\n{rec_blocks}\n"
+    )
+
+@cache.memoize(timeout=60)
+def _export_section_cached(ws_id: int, cat: str, version: int) -> tuple[str | None, bytes]:
+    """
+    單一類別的匯出內容（已 encode）+ 目標日期（檔名用）。
+    version = workspaces.rev：每次寫入都 +1，key 跟著換；
+    不用刪舊快取，多個 worker 各自的 SimpleCache 也不會拿到舊版本。
+    """
+    d = load_export_data(ws_id, (cat,))[cat]
+    obj = d["obj"]
+    return (obj[0] if obj else None), _export_section(cat, obj, d["groups"], d["recs"]).encode("utf-8")
+
+_EXPORT_BOM = "\ufeff".encode("utf-8")  # 等同 utf-8-sig
+_EXPORT_SEP = "\n========\n\n".encode("utf-8")
 
-    return "\n".join(lines)
+def iter_export_chunks(sections: list[bytes]) -> Iterator[bytes]:
+    """匯出 .txt 的各塊：BOM + 各類別內容，類別之間夾分隔線"""
+    for n, body in enumerate(sections):
+        yield (_EXPORT_SEP if n else _EXPORT_BOM) + body  # ✅ 分隔線只在中間出現一次
 
 @app.route("/export/<code>")
 def export(code: str):
@@ -655,17 +1035,14 @@ def export(code: str):
 
     ws_id = ws["id"]
 
-    if cat == "both":
-        obj_a = get_objectives(ws_id, "定向")
-        obj_b = get_objectives(ws_id, "生活")
+    # 每個類別各自快取；檔名日期也從同一份快取拿，不另外查 objectives
+    cats = ("定向", "生活") if cat == "both" else (cat,)
+    parts = [_export_section_cached(ws_id, c, ws["rev"]) for c in cats]
 
-        date_for_name = pick_latest_ymd(
-            obj_a["target_date"] if obj_a else "",
-            obj_b["target_date"] if obj_b else "",
-        )
+    if cat == "both":
+        date_for_name = pick_latest_ymd(*(d or "" for d, _ in parts))
     else:
-        obj = get_objectives(ws_id, cat)
-        date_for_name = (obj["target_date"] if obj else today_ymd())
+        date_for_name = (parts[0][0] or today_ymd())
 
     ymd = date_for_name.replace("-", "")
 
@@ -676,22 +1053,33 @@ def export(code: str):
     # cat 直接用原字串（定向/生活/both），不要 safe_name(cat)
     filename = f"{ymd}_{student}_{cat}_{ws['code']}.txt"
 
-    text = build_export_text(ws_id, cat).encode("utf-8-sig")
-    return send_file(
-        BytesIO(text),
-        as_attachment=True,
-        download_name=filename,
-        mimetype="text/plain; charset=utf-8",
+    # 各類別內容本來就是快取好的 bytes，直接接成一整包送：
+    # 有 Content-Length（手機看得到下載進度），也跟以前 send_file 一樣支援 Range 續傳
+    body = b"".join(iter_export_chunks([b for _, b in parts]))
+    resp = Response(body, mimetype="text/plain; charset=utf-8")
+    resp.make_conditional(request, accept_ranges=True, complete_length=len(body))
+    # 個人資料：跟以前 send_file 一樣要求每次回源確認
+    resp.cache_control.no_cache = True
+    # 中文檔名：filename 給 ASCII 備援，filename* 給 UTF-8 原名（ASCII 檔名也一律帶 filename*）
+    ascii_name = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+    resp.headers.set(
+        "Content-Disposition", "attachment",
+        filename=ascii_name, **{"filename*": f"UTF-8''{quote(filename, safe='!#$&+^`|~')}"}
     )
+    return resp
+
+_WIN_FORBIDDEN_RE = re.compile(r'[\\/:*?"<>|]+')
+_SPACES_RE = re.compile(r"\s+")
+_NAME_DISALLOWED_RE = re.compile(r"[^0-9A-Za-z\u4e00-\u9fff._-]+")
 
 def safe_name(s: str) -> str:
     s = (s or "").strip()
     # Windows 檔名禁用字元先換成底線
-    s = re.sub(r'[\\/:*?"<>|]+', "_", s)
+    s = _WIN_FORBIDDEN_RE.sub("_", s)
     # 空白變底線
-    s = re.sub(r"\s+", "_", s)
+    s = _SPACES_RE.sub("_", s)
     # 只保留：中英數、底線、連字號、點
-    s = re.sub(r"[^0-9A-Za-z\u4e00-\u9fff._-]+", "", s)
+    s = _NAME_DISALLOWED_RE.sub("", s)
     return s.strip("._-")[:80]
 
 @app.route("/ack-code", methods=["POST"])
@@ -705,25 +1093,27 @@ def ack_code():
 
 @app.post("/api/delete-workspace")
 def api_delete_workspace():
-    data = request.get_json(silent=True) or {}
-    code = (request.form.get("code") or data.get("code") or "").strip()
+    # JSON 只在 Content-Type 是 JSON 時才解析；其他一律當表單
+    if request.is_json:
+        code = (request.get_json(silent=True) or {}).get("code")
+    else:
+        code = request.form.get("code")
+    code = str(code or "").strip()
     if not code:
         return jsonify({"ok": False, "error": "missing code"}), 400
 
+    # 一個 DELETE 搞定，RETURNING 有東西才代表真的刪到
     with get_conn() as conn:
-        ws = conn.execute("SELECT id FROM workspaces WHERE code=?", (code,)).fetchone()
-        if not ws:
-            return jsonify({"ok": False, "error": "not found"}), 404
-        conn.execute("DELETE FROM workspaces WHERE id=?", (ws["id"],))
+        ws = conn.execute("DELETE FROM workspaces WHERE code=? RETURNING id", (code,)).fetchone()
+    g.get("_ws_by_code", {}).pop(code, None)
+    if not ws:
+        return jsonify({"ok": False, "error": "not found"}), 404
     return jsonify({"ok": True})
 
-try:
-    n = cleanup_expired_workspaces()
-    if n:
-        print(f"[cleanup] removed {n} workspaces")
-except Exception as e:
-    print("[cleanup] failed:", e)
+# 過期清理放背景 thread 跑，不擋第一個 request
+_schedule_cleanup(1)
 
 if __name__ == "__main__":
+    # 開發用 Werkzeug server；正式環境走 gunicorn（Procfile / gunicorn_conf.py）
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,21 @@
+"""
+gunicorn 設定（正式環境用）：
+    gunicorn -c gunicorn_conf.py app:app
+本機開發仍可直接 `python app.py`。
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# 多 worker 吃滿 CPU，每個 worker 幾條 thread 處理 I/O 等待
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# 手機常常連續點好幾頁，TCP 連線保留一下再關
+keepalive = 5
+
+# 不 preload：每個 worker 自己 import app，
+# SQLite 連線池在 fork 之後才建立，不會有跨 process 共用的連線 fd
+preload_app = False